@@ -1,19 +1,84 @@
+import asyncio
+import csv
+import hashlib
+import json
+import logging
+import logging.handlers
 import os
-import pandas as pd
+import queue
+import re
+import time
 import io
 from datetime import datetime
 from dotenv import load_dotenv
 from telegram import Update
+from telegram.error import BadRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from openai import OpenAI
+import httpx
+import redis.asyncio as aioredis
+import tiktoken
+from aiolimiter import AsyncLimiter
+from openai import AsyncOpenAI, APIStatusError
+from cachetools import LRUCache
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 
 # Загружаем переменные из .env файла
 load_dotenv()
 
-# Инициализация OpenRouter клиента
-client = OpenAI(
+# Логи уходят в очередь, а пишет их в stdout отдельный поток слушателя —
+# event loop не блокируется на синхронных flush'ах под нагрузкой
+log_queue = queue.SimpleQueue()
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_listener = logging.handlers.QueueListener(log_queue, _stream_handler)
+_log_listener.start()
+
+logger = logging.getLogger("bot")
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+# pandas и pyarrow грузим лениво: импорт стоит сотни миллисекунд и ~80MB
+# памяти, а нужен только при работе с файлами — без него бот стартует быстрее
+pd = None
+pa = None
+pacsv = None
+
+def _load_pandas():
+    """Импортируем pandas/pyarrow при первом обращении к файлам"""
+    global pd, pa, pacsv
+    if pd is None:
+        import pandas
+        import pyarrow
+        import pyarrow.csv
+        pd = pandas
+        pa = pyarrow
+        pacsv = pyarrow.csv
+        # Ограничиваем вывод pandas, чтобы случайно не форматировать миллионы строк
+        pd.options.display.max_rows = 50
+        pd.options.display.max_colwidth = 40
+    return pd
+
+# Сколько строк показываем модели (начало и конец таблицы)
+PREVIEW_HEAD_ROWS = 20
+PREVIEW_TAIL_ROWS = 5
+
+# Папка для сохранения полных данных пользователей
+DATA_DIR = "user_data"
+
+# Ограничиваем число одновременных парсингов, чтобы не забить пул потоков
+parse_semaphore = asyncio.Semaphore(4)
+
+# Инициализация OpenRouter клиента.
+# Асинхронный клиент — синхронный блокировал бы event loop на всё время
+# ответа модели. Один httpx-клиент на процесс, чтобы переиспользовать
+# keep-alive соединения между запросами.
+client = AsyncOpenAI(
     api_key=os.getenv("OPENROUTER_API_KEY"),
-    base_url="https://openrouter.ai/api/v1"
+    base_url="https://openrouter.ai/api/v1",
+    http_client=httpx.AsyncClient(
+        timeout=120,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+    )
 )
 
 # Список доступных бесплатных моделей в порядке приоритета
@@ -25,7 +90,16 @@ MODELS = [
     "nousresearch/nous-hermes-2-mixtral-8x7b-dpo",  # Nous Hermes
 ]
 
-current_model_index = 0
+# Скользящая статистика по моделям: по ней выбираем, кого спрашивать первым
+model_stats = {m: {"ewma_latency": 5.0, "failures": 0} for m in MODELS}
+EWMA_ALPHA = 0.3       # вес свежего замера в скользящей задержке
+HEDGE_DELAY = 2.0      # через сколько секунд подключаем страхующую модель
+ATTEMPT_TIMEOUT = 15   # максимум ожидания ответа одной модели, секунд
+
+def _model_score(model):
+    """Чем меньше score, тем раньше пробуем модель"""
+    stats = model_stats[model]
+    return stats["ewma_latency"] * (1 + stats["failures"])
 
 # Промпт для анализа маркетплейсов
 SYSTEM_PROMPT = """Ты профессиональный аналитик маркетплейсов с опытом работы с Ozon, Wildberries, Яндекс.Маркет и другими платформами.
@@ -83,38 +157,478 @@ ABC-анализ товаров:
 
 Если в данных не хватает информации для полного анализа (например, себестоимость), скажи об этом явно и попроси недостающие данные."""
 
-# Хранилище контекста диалога для каждого пользователя
-user_conversations = {}
+# Бюджет контекста: токены системного промпта считаем один раз при импорте,
+# а превью данных обрезаем так, чтобы запрос гарантированно влез в окно модели
+# и не вызывал ошибку провайдера (и лишнюю ротацию моделей)
+_encoder = tiktoken.get_encoding("cl100k_base")
+SYSTEM_PROMPT_TOKENS = len(_encoder.encode(SYSTEM_PROMPT))
 
-async def call_ai_with_fallback(messages):
-    """Функция для вызова AI с автоматическим переключением моделей при ошибке"""
-    global current_model_index
-    
-    for attempt in range(len(MODELS)):
-        model = MODELS[current_model_index]
+# Окна контекста моделей из MODELS; бюджет считаем по худшему случаю, чтобы
+# запрос влез в любую модель, на которую может упасть выбор при фолбэке
+MODEL_CONTEXT_WINDOWS = {
+    "meta-llama/llama-2-70b-chat": 4096,
+    "meta-llama/llama-3-70b-instruct": 8192,
+    "mistralai/mistral-7b-instruct": 8192,
+    "meta-llama/llama-2-13b-chat": 4096,
+    "nousresearch/nous-hermes-2-mixtral-8x7b-dpo": 32768,
+}
+MIN_CONTEXT_TOKENS = min(MODEL_CONTEXT_WINDOWS[m] for m in MODELS)
+RESPONSE_RESERVE_TOKENS = 1000  # max_tokens ответа: вместе с промптом должен влезать в 4096
+HISTORY_RESERVE_TOKENS = 800    # запас на остальную историю диалога
+
+def fit_preview_to_budget(preview):
+    """Обрезаем превью по числу токенов, а не «на глаз» по символам"""
+    budget = max(MIN_CONTEXT_TOKENS - SYSTEM_PROMPT_TOKENS
+                 - RESPONSE_RESERVE_TOKENS - HISTORY_RESERVE_TOKENS, 0)
+    tokens = _encoder.encode(preview)
+    if len(tokens) <= budget:
+        return preview
+    return _encoder.decode(tokens[:budget]) + "\n…(превью обрезано по лимиту контекста)"
+
+# Хранилище контекста диалога. С REDIS_URL истории живут в Redis — бот можно
+# запускать в несколько воркеров, и диалоги переживают рестарт. Без него
+# остаёмся на LRU в памяти (локальная разработка); LRU вытесняет давно
+# неактивных, чтобы память процесса не росла бесконечно.
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = aioredis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+HISTORY_TTL = 7 * 24 * 3600  # неделя неактивности — и история истекает
+
+user_conversations = LRUCache(maxsize=10_000)
+
+async def get_history(user_id):
+    """История диалога пользователя из Redis или из памяти"""
+    if redis_client is None:
+        return user_conversations.setdefault(user_id, new_history())
+    raw = await redis_client.get(f"history:{user_id}")
+    return json.loads(raw) if raw else new_history()
+
+async def set_history(user_id, messages):
+    """Сохраняем историю диалога с TTL"""
+    if redis_client is None:
+        user_conversations[user_id] = messages
+        return
+    await redis_client.set(
+        f"history:{user_id}",
+        json.dumps(messages, ensure_ascii=False),
+        ex=HISTORY_TTL
+    )
+
+# Неизменное первое сообщение пользователя. Кэширование промпта у провайдера
+# работает только на байт-в-байт одинаковом префиксе, поэтому стабильная часть
+# (системный промпт + профиль) идёт первой, а данные файлов — отдельными
+# сообщениями в конце истории.
+USER_PROFILE_MESSAGE = {
+    "role": "user",
+    "content": "Я продавец на маркетплейсах. Буду присылать выгрузки данных и задавать вопросы по ним."
+}
+
+def new_history():
+    """Новая история диалога со стабильным префиксом"""
+    return [dict(USER_PROFILE_MESSAGE)]
+
+# Сколько последних сообщений храним в истории диалога
+MAX_HISTORY = 12
+
+# Долгая память: сообщения, вытесненные из скользящего окна, складываем в
+# архив и по запросу достаём top-k релевантных вместо отправки всей истории
+memory_archive = LRUCache(maxsize=10_000)  # user_id -> [текст сообщения, ...]
+MEMORY_TOP_K = 5
+MAX_ARCHIVE_ENTRIES = 200
+MAX_ARCHIVE_CHARS = 500  # превью файлов в архиве храним усечёнными
+
+def _tokenize(text):
+    return set(re.findall(r"\w+", text.lower()))
+
+def archive_messages(user_id, messages):
+    """Складываем вытесненные из окна сообщения в архив пользователя"""
+    archive = memory_archive.setdefault(user_id, [])
+    for msg in messages:
+        archive.append(msg["content"][:MAX_ARCHIVE_CHARS])
+    del archive[:-MAX_ARCHIVE_ENTRIES]
+
+def recall_memories(user_id, query, k=MEMORY_TOP_K):
+    """Top-k архивных сообщений по пересечению слов с вопросом"""
+    archive = memory_archive.get(user_id) or []
+    query_words = _tokenize(query)
+    if not query_words:
+        return []
+    scored = []
+    for content in archive:
+        words = _tokenize(content)
+        overlap = len(query_words & words)
+        if overlap:
+            scored.append((overlap / len(query_words | words), content))
+    scored.sort(key=lambda pair: pair[0], reverse=True)
+    return [content for _, content in scored[:k]]
+
+def trim_history(user_id, messages):
+    """Оставляем только последние MAX_HISTORY сообщений.
+
+    Без ограничения каждый запрос к API отправляет всю историю заново,
+    и стоимость растёт квадратично за сессию. Системный промпт в списке
+    не хранится (он добавляется в call_ai_with_fallback), поэтому просто
+    отрезаем хвост; вытесненные сообщения уходят в архив памяти. Чтобы не
+    начинать историю с ответа ассистента без вопроса, срез сдвигаем до
+    ближайшего сообщения пользователя."""
+    if len(messages) <= MAX_HISTORY:
+        return messages
+    # Профильное сообщение — стабильный префикс, его не вытесняем
+    prefix = [messages[0]] if messages[0] == USER_PROFILE_MESSAGE else []
+    trimmed = messages[-MAX_HISTORY:]
+    while trimmed and trimmed[0]["role"] == "assistant":
+        trimmed = trimmed[1:]
+    archive_messages(user_id, messages[len(prefix):len(messages) - len(trimmed)])
+    return prefix + trimmed
+
+def _to_csv_text(df):
+    """Сериализуем срез таблицы в CSV нативным Arrow-писателем:
+    на порядок быстрее df.to_string() и вдвое компактнее (нет выравнивания
+    пробелами), а CSV модели читают не хуже фиксированных колонок"""
+    try:
+        # Object-колонки со смешанными типами (числа + текстовая ячейка —
+        # обычное дело в Excel-выгрузках) Arrow не переварит — приводим к str
+        safe = df.copy()
+        for col in safe.columns:
+            if pd.api.types.is_object_dtype(safe[col]):
+                safe[col] = safe[col].astype(str)
+        buf = io.BytesIO()
+        pacsv.write_csv(pa.Table.from_pandas(safe, preserve_index=False), buf)
+        return buf.getvalue().decode()
+    except Exception:
+        # Остались экзотические типы — медленный, но всеядный путь pandas
+        return df.to_csv(index=False)
+
+def build_data_preview(df, filename):
+    """Компактное описание файла для модели: схема, начало/конец таблицы и статистика.
+
+    Полный дамп на больших выгрузках занимает сотни мегабайт и всё
+    равно не влезает в контекст модели, поэтому отправляем только срез."""
+    head = df.head(PREVIEW_HEAD_ROWS)
+    tail = df.tail(PREVIEW_TAIL_ROWS)
+    stats = df.describe(include='all').transpose()
+
+    preview = f"Файл: {filename}\n\n"
+    preview += f"Размер: {len(df)} строк, {len(df.columns)} колонок\n\n"
+    preview += "Колонки и типы данных:\n"
+    for col, dtype in df.dtypes.to_dict().items():
+        preview += f"  {col}: {dtype}\n"
+    preview += f"\nПервые {len(head)} строк (CSV):\n"
+    preview += _to_csv_text(head)
+    preview += f"\nПоследние {len(tail)} строк (CSV):\n"
+    preview += _to_csv_text(tail)
+    preview += "\nСтатистика по колонкам (CSV):\n"
+    preview += stats.to_csv()
+    return fit_preview_to_budget(preview)
+
+# Сколько строк читаем для вывода типов колонок перед полным чтением CSV
+CSV_SAMPLE_ROWS = 1000
+
+def _read_csv(data):
+    """Читаем CSV в два прохода: разделитель и типы определяем по небольшой
+    выборке, затем читаем весь файл с готовыми dtype — без полного
+    скана на инференс типов"""
+    head_text = bytes(data[:4096]).decode('utf-8', errors='ignore')
+    try:
+        # Выгрузки маркетплейсов часто идут с ';' вместо ','
+        sep = csv.Sniffer().sniff(head_text, delimiters=';,\t').delimiter
+    except csv.Error:
+        sep = ','
+    sample = pd.read_csv(io.BytesIO(data), sep=sep, nrows=CSV_SAMPLE_ROWS)
+    try:
+        return pd.read_csv(io.BytesIO(data), sep=sep, engine='pyarrow',
+                           dtype=sample.dtypes.to_dict())
+    except Exception:
+        # Типы из выборки не подошли всему файлу (пропуск или дробное число
+        # в "целой" колонке после 1000-й строки) — перечитываем без подсказок
+        return pd.read_csv(io.BytesIO(data), sep=sep, engine='pyarrow')
+
+# Парсеры по расширению файла: calamine (Rust) для Excel и pyarrow для CSV
+# на порядки быстрее дефолтных openpyxl / питоновского парсера CSV
+FILE_READERS = {
+    '.xlsx': lambda data: pd.read_excel(io.BytesIO(data), engine='calamine'),
+    '.xls': lambda data: pd.read_excel(io.BytesIO(data), engine='calamine'),
+    '.csv': _read_csv,
+}
+
+def read_uploaded_file(file_bytes, filename):
+    """Читаем файл подходящим парсером; None — расширение не поддерживается"""
+    suffix = os.path.splitext(filename)[1].lower()
+    reader = FILE_READERS.get(suffix)
+    if reader is None:
+        return None
+    return reader(file_bytes)
+
+def downcast_dataframe(df):
+    """Сжимаем типы колонок после парсинга.
+
+    Дефолтные int64/float64/object занимают в 2-8 раз больше памяти, чем
+    нужно, а распарсенные таблицы у нас живут в кэше и на диске. Числа
+    ужимаем до минимально достаточных типов, строки с малым числом
+    уникальных значений переводим в category."""
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_integer_dtype(series):
+            df[col] = pd.to_numeric(series, downcast='integer')
+        elif pd.api.types.is_float_dtype(series):
+            df[col] = pd.to_numeric(series, downcast='float')
+        elif (pd.api.types.is_object_dtype(series)
+              and series.nunique(dropna=True) < len(series) * 0.5):
+            df[col] = series.astype('category')
+    return df
+
+# Папка и индекс кэша распарсенных файлов: пользователи часто присылают одну
+# и ту же еженедельную выгрузку, а чтение parquet на порядки быстрее
+# повторного парсинга xlsx
+PARSE_CACHE_DIR = "cache"
+parse_cache = LRUCache(maxsize=256)  # хеш файла -> (путь к parquet, превью)
+
+def load_or_parse_file(file_bytes, filename):
+    """Парсим файл или берём результат из кэша по хешу содержимого"""
+    _load_pandas()
+    key = hashlib.blake2b(bytes(file_bytes), digest_size=16).hexdigest()
+    cached = parse_cache.get(key)
+    if cached is not None:
+        df_path, preview = cached
+        if os.path.exists(df_path):
+            if df_path.endswith('.pkl'):
+                return pd.read_pickle(df_path), preview
+            return pd.read_parquet(df_path), preview
+
+    df = read_uploaded_file(file_bytes, filename)
+    if df is None:
+        return None, None
+    df = downcast_dataframe(df)
+    preview = build_data_preview(df, filename)
+
+    os.makedirs(PARSE_CACHE_DIR, exist_ok=True)
+    df_path = os.path.join(PARSE_CACHE_DIR, f"{key}.parquet")
+    try:
+        df.to_parquet(df_path)
+    except Exception:
+        # Смешанные типы в object-колонках parquet не переварит — пишем pickle
+        df_path = os.path.join(PARSE_CACHE_DIR, f"{key}.pkl")
+        df.to_pickle(df_path)
+    parse_cache[key] = (df_path, preview)
+    return df, preview
+
+def save_user_dataframe(df, user_id):
+    """Сохраняем полные данные на диск, чтобы не держать их в промпте"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    df.to_pickle(os.path.join(DATA_DIR, f"{user_id}.pkl"))
+
+# Лимит Telegram на длину одного сообщения
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Telegram пропускает ~1 сообщение в секунду на чат — не нарываемся на flood control
+telegram_send_limiter = AsyncLimiter(1, 1)
+
+def split_message(text):
+    """Режем длинный текст по границам абзацев, чтобы не рвать предложения"""
+    chunks = []
+    current = ""
+    for para in text.split("\n\n"):
+        candidate = para if not current else current + "\n\n" + para
+        if len(candidate) <= TELEGRAM_MESSAGE_LIMIT:
+            current = candidate
+            continue
+        if current:
+            chunks.append(current)
+        # Абзац сам по себе длиннее лимита — режем жёстко
+        while len(para) > TELEGRAM_MESSAGE_LIMIT:
+            chunks.append(para[:TELEGRAM_MESSAGE_LIMIT])
+            para = para[TELEGRAM_MESSAGE_LIMIT:]
+        current = para
+    if current:
+        chunks.append(current)
+    return chunks
+
+class StreamingReply:
+    """Инкрементальная отдача ответа: одно сообщение Telegram редактируется
+    по мере генерации токенов (не чаще раза в секунду), а по завершении
+    хвост длиннее лимита уходит отдельными сообщениями"""
+
+    EDIT_INTERVAL = 1.0  # секунд между edit_text, чтобы не ловить flood control
+
+    def __init__(self, update):
+        self.update = update
+        self.message = None
+        self.last_edit = 0.0
+        self.lead_model = None
+
+    async def start(self, placeholder):
+        self.message = await self.update.message.reply_text(placeholder)
+
+    async def on_delta(self, model, text):
+        # При hedged-запросах поток показываем только от первой ответившей модели
+        if self.lead_model is None:
+            self.lead_model = model
+        if model != self.lead_model or not text.strip():
+            return
+        now = time.monotonic()
+        if now - self.last_edit < self.EDIT_INTERVAL:
+            return
+        self.last_edit = now
+        try:
+            await self.message.edit_text(text[-TELEGRAM_MESSAGE_LIMIT:])
+        except Exception:
+            pass  # edit мог не пройти (текст не изменился и т.п.) — не критично
+
+    async def _send_first_chunk(self, chunk):
+        """Первый кусок ответа терять нельзя: если финальный edit не прошёл
+        (flood control и т.п.) — отправляем его обычным сообщением"""
         try:
-            messages_with_system = [{"role": "system", "content": SYSTEM_PROMPT}] + messages
-            response = client.chat.completions.create(
+            await self.message.edit_text(chunk)
+        except BadRequest as e:
+            # "message is not modified" значит, что текст уже на месте
+            if "not modified" in str(e).lower():
+                return
+            async with telegram_send_limiter:
+                await self.update.message.reply_text(chunk)
+        except Exception:
+            async with telegram_send_limiter:
+                await self.update.message.reply_text(chunk)
+
+    async def finish(self, text):
+        # split_message("") вернул бы [] — не оставляем пользователя с "⏳"
+        chunks = split_message(text) or ["🤷 Модель не вернула ответ. Попробуйте ещё раз."]
+        await self._send_first_chunk(chunks[0])
+        # Хвост отправляем строго по порядку: у параллельных sendMessage
+        # Telegram не гарантирует очерёдность доставки
+        for chunk in chunks[1:]:
+            async with telegram_send_limiter:
+                await self.update.message.reply_text(chunk)
+
+def _is_transient_error(exc):
+    """429/503 — временные проблемы провайдера: повторить ту же модель позже.
+
+    Немедленный ретрай на rate-limit только усугубляет лимит, а ротация
+    моделей из-за него бессмысленна — ошибка не в модели."""
+    return isinstance(exc, APIStatusError) and exc.status_code in (429, 503)
+
+@retry(
+    wait=wait_random_exponential(min=1, max=20),
+    stop=stop_after_attempt(3),
+    retry=retry_if_exception(_is_transient_error),
+    reraise=True
+)
+async def _call_model(model, messages_with_system, reply=None, first_token=None):
+    """Один стриминговый запрос к одной модели с обновлением статистики.
+
+    first_token — событие, которым сигналим о первой полученной дельте:
+    для хеджирования "модель ответила" значит "начала стримить".
+    На 429/503 повторяем ту же модель с экспоненциальной паузой и джиттером;
+    остальные ошибки сразу уходят наверх и приводят к смене модели."""
+    stats = model_stats[model]
+    start = time.monotonic()
+    try:
+        # Таймаут только на установку соединения и первые байты ответа;
+        # чтение самого потока ограничено таймаутом httpx-клиента
+        stream = await asyncio.wait_for(
+            client.chat.completions.create(
                 model=model,
-                max_tokens=4000,
+                max_tokens=RESPONSE_RESERVE_TOKENS,
                 messages=messages_with_system,
-                temperature=0.7
-            )
-            return response.choices[0].message.content, model
-        except Exception as e:
-            print(f"⚠️ Ошибка с моделью {model}: {str(e)}")
-            current_model_index = (current_model_index + 1) % len(MODELS)
-            
-            if attempt == len(MODELS) - 1:
-                raise Exception(f"❌ Все модели недоступны. Последняя ошибка: {str(e)}")
-    
-    return None, None
+                temperature=0.7,
+                stream=True
+            ),
+            timeout=ATTEMPT_TIMEOUT
+        )
+        parts = []
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            if delta:
+                parts.append(delta)
+                if first_token is not None:
+                    first_token.set()
+                if reply is not None:
+                    await reply.on_delta(model, "".join(parts))
+        content = "".join(parts)
+        if not content.strip():
+            # Пустой поток — это не ответ: считаем отказом и идём к другой модели
+            raise ValueError("модель вернула пустой ответ")
+    except Exception as e:
+        stats["failures"] += 1
+        logger.warning(f"⚠️ Ошибка с моделью {model}: {str(e)}")
+        raise
+    elapsed = time.monotonic() - start
+    stats["ewma_latency"] = EWMA_ALPHA * elapsed + (1 - EWMA_ALPHA) * stats["ewma_latency"]
+    stats["failures"] = 0
+    return content, model
+
+async def call_ai_with_fallback(messages, reply=None):
+    """Вызов AI с переключением моделей при ошибке.
+
+    Модели ранжируются по скользящей задержке и числу отказов и пробуются
+    по очереди; если текущая модель за HEDGE_DELAY секунд не выдала ни
+    одного токена, параллельно запускается страхующий запрос к следующей
+    по рангу (не больше двух одновременно). Начавшийся стрим считается
+    ответом: пока лидер стримит, страховка не запускается, а молчащий
+    дублёр отменяется — иначе каждый ход оплачивался бы дважды. Упавшая
+    задача сразу замещается следующей моделью, поэтому быстрые ошибки
+    (400/404, авторизация) не пропускают модели."""
+    # cache_control живёт внутри частей content сообщения — только там
+    # OpenRouter учитывает его при кэшировании стабильного префикса
+    system_message = {
+        "role": "system",
+        "content": [{
+            "type": "text",
+            "text": SYSTEM_PROMPT,
+            "cache_control": {"type": "ephemeral"}
+        }]
+    }
+    messages_with_system = [system_message] + messages
+    ranked = sorted(MODELS, key=_model_score)
+    last_error = None
+    next_index = 0
+    tasks = {}  # задача -> Event первого токена
+
+    def start_next():
+        nonlocal next_index
+        first_token = asyncio.Event()
+        task = asyncio.create_task(
+            _call_model(ranked[next_index], messages_with_system, reply, first_token)
+        )
+        tasks[task] = first_token
+        next_index += 1
+
+    while tasks or next_index < len(ranked):
+        if not tasks:
+            start_next()
+        done, _ = await asyncio.wait(set(tasks), timeout=HEDGE_DELAY,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            streaming = [t for t, ev in tasks.items() if ev.is_set()]
+            if streaming:
+                # Лидер уже стримит — страховка не нужна, молчунов отменяем
+                for task, first_token in list(tasks.items()):
+                    if not first_token.is_set():
+                        task.cancel()
+            elif len(tasks) < 2 and next_index < len(ranked):
+                # Ни одного токена за HEDGE_DELAY — подключаем следующую модель
+                start_next()
+            continue
+        for task in done:
+            tasks.pop(task, None)
+            try:
+                result = task.result()
+            except asyncio.CancelledError:
+                continue
+            except Exception as e:
+                last_error = e
+                continue
+            for loser in tasks:
+                loser.cancel()
+            return result
+
+    raise Exception(f"❌ Все модели недоступны. Последняя ошибка: {str(last_error)}")
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Команда /start"""
     user_id = update.effective_user.id
-    user_conversations[user_id] = []
-    
+    await set_history(user_id, new_history())
+
     await update.message.reply_text(
         "👋 Привет! Я ваш аналитик маркетплейсов.\n\n"
         "Я помогу вам разобраться в выгрузках данных с Ozon, Wildberries, Яндекс.Маркета и других платформ.\n\n"
@@ -124,60 +638,77 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "Я проанализирую всё и дам конкретные рекомендации!"
     )
 
+async def _run_turn(update, user_id, history, user_content, placeholder, memories=None):
+    """Общий конвейер хода диалога для обоих обработчиков: добавить сообщение
+    пользователя, спросить модель со стримингом, сохранить ответ и отправить.
+
+    Возвращает имя ответившей модели."""
+    # Ответ показываем по мере генерации, редактируя одно сообщение
+    reply = StreamingReply(update)
+    await reply.start(placeholder)
+
+    # Добавляем сообщение пользователя в историю
+    history.append({
+        "role": "user",
+        "content": user_content
+    })
+    history = trim_history(user_id, history)
+
+    # Релевантные архивные сообщения подкладываем отдельным сообщением перед
+    # вопросом (не в системный промпт — он должен оставаться байт-в-байт
+    # стабильным ради кэширования); в историю они не сохраняются
+    prompt_messages = history
+    if memories:
+        memory_message = {
+            "role": "user",
+            "content": "Контекст из более ранних сообщений этого диалога:\n- " + "\n- ".join(memories)
+        }
+        prompt_messages = history[:-1] + [memory_message, history[-1]]
+
+    # Вызываем AI с автоматическим переключением
+    assistant_message, used_model = await call_ai_with_fallback(prompt_messages, reply)
+
+    # Сохраняем ответ в историю
+    history.append({
+        "role": "assistant",
+        "content": assistant_message
+    })
+    await set_history(user_id, trim_history(user_id, history))
+
+    # Финальный текст целиком (хвост длиннее лимита — отдельными сообщениями)
+    await reply.finish(assistant_message)
+    return used_model
+
 async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработка загруженных файлов"""
     user_id = update.effective_user.id
-    
-    if user_id not in user_conversations:
-        user_conversations[user_id] = []
-    
+    history = await get_history(user_id)
+
     try:
         # Получаем файл
         file = await update.message.document.get_file()
         file_bytes = await file.download_as_bytearray()
-        
+
         # Определяем тип файла
         filename = update.message.document.file_name
-        
-        # Читаем файл в зависимости от расширения
-        if filename.endswith('.xlsx') or filename.endswith('.xls'):
-            df = pd.read_excel(io.BytesIO(file_bytes))
-        elif filename.endswith('.csv'):
-            df = pd.read_csv(io.BytesIO(file_bytes))
-        else:
-            await update.message.reply_text("❌ Поддерживаются только файлы Excel (.xlsx, .xls) и CSV")
-            return
-        
-        # Преобразуем данные в текстовый формат
-        data_preview = f"Файл: {filename}\n\n"
-        data_preview += f"Размер: {len(df)} строк, {len(df.columns)} колонок\n\n"
-        data_preview += "Колонки: " + ", ".join(df.columns.tolist()) + "\n\n"
-        data_preview += "Данные:\n" + df.to_string()
-        
-        # Отправляем сообщение пользователю
-        await update.message.reply_text("⏳ Анализирую данные... (это может занять некоторое время)")
-        
-        # Добавляем сообщение пользователя в историю
-        user_conversations[user_id].append({
-            "role": "user",
-            "content": f"Вот мои данные с маркетплейса:\n\n{data_preview}"
-        })
-        
-        # Вызываем AI с автоматическим переключением
-        assistant_message, used_model = await call_ai_with_fallback(user_conversations[user_id])
-        
-        # Сохраняем ответ в историю
-        user_conversations[user_id].append({
-            "role": "assistant",
-            "content": assistant_message
-        })
-        
-        # Отправляем ответ пользователю частями (по 4096 символов)
-        for i in range(0, len(assistant_message), 4096):
-            await update.message.reply_text(assistant_message[i:i+4096])
-        
-        print(f"✅ Анализ выполнен моделью: {used_model}")
-            
+
+        # Парсим в отдельном потоке, чтобы не блокировать event loop для других пользователей
+        async with parse_semaphore:
+            df, data_preview = await asyncio.to_thread(load_or_parse_file, file_bytes, filename)
+            if df is None:
+                await update.message.reply_text("❌ Поддерживаются только файлы Excel (.xlsx, .xls) и CSV")
+                return
+
+            # Сохраняем полные данные на диск, а модели отправляем компактный срез
+            await asyncio.to_thread(save_user_dataframe, df, user_id)
+
+        used_model = await _run_turn(
+            update, user_id, history,
+            f"Вот мои данные с маркетплейса:\n\n{data_preview}",
+            "⏳ Анализирую данные... (это может занять некоторое время)"
+        )
+        logger.info(f"✅ Анализ выполнен моделью: {used_model}")
+
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка при обработке файла: {str(e)}")
 
@@ -185,41 +716,28 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     """Обработка текстовых сообщений (вопросов)"""
     user_id = update.effective_user.id
     user_text = update.message.text
-    
-    if user_id not in user_conversations:
-        user_conversations[user_id] = []
-    
-    # Добавляем сообщение в историю
-    user_conversations[user_id].append({
-        "role": "user",
-        "content": user_text
-    })
-    
+    history = await get_history(user_id)
+
     try:
-        await update.message.reply_text("⏳ Ищу ответ...")
-        
-        # Вызываем AI с автоматическим переключением
-        assistant_message, used_model = await call_ai_with_fallback(user_conversations[user_id])
-        
-        # Сохраняем ответ в историю
-        user_conversations[user_id].append({
-            "role": "assistant",
-            "content": assistant_message
-        })
-        
-        # Отправляем ответ пользователю частями
-        for i in range(0, len(assistant_message), 4096):
-            await update.message.reply_text(assistant_message[i:i+4096])
-        
-        print(f"✅ Ответ от модели: {used_model}")
-            
+        memories = recall_memories(user_id, user_text)
+        used_model = await _run_turn(
+            update, user_id, history, user_text, "⏳ Ищу ответ...", memories
+        )
+        logger.info(f"✅ Ответ от модели: {used_model}")
+
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {str(e)}\nПроверьте OPENROUTER_API_KEY в файле .env")
 
 async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Команда /reset для очистки истории"""
     user_id = update.effective_user.id
-    user_conversations[user_id] = []
+    await set_history(user_id, new_history())
+    # Чистим и долгую память, и сохранённые данные: пользователь явно
+    # попросил начать с чистого листа, старый контекст всплывать не должен
+    memory_archive.pop(user_id, None)
+    data_path = os.path.join(DATA_DIR, f"{user_id}.pkl")
+    if os.path.exists(data_path):
+        os.remove(data_path)
     await update.message.reply_text("🔄 История диалога очищена. Готов к новому анализу!")
 
 async def models(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -229,6 +747,14 @@ async def models(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 def main() -> None:
     """Запуск бота"""
+    # uvloop — drop-in замена стандартного event loop, заметно быстрее на
+    # Linux; на других платформах его просто нет, работаем на стандартном
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
     # Получаем токен из переменной окружения
     token = os.getenv("TELEGRAM_BOT_TOKEN")
     if not token:
@@ -249,10 +775,22 @@ def main() -> None:
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     
     # Запускаем бота
-    print("🤖 Бот запущен с OpenRouter!")
-    print(f"✅ Доступно {len(MODELS)} моделей с автоматическим переключением")
-    print("📋 Команды: /start, /reset, /models")
-    application.run_polling()
+    logger.info("🤖 Бот запущен с OpenRouter!")
+    logger.info(f"✅ Доступно {len(MODELS)} моделей с автоматическим переключением")
+    logger.info("📋 Команды: /start, /reset, /models")
+
+    # С WEBHOOK_URL работаем через вебхук (нет задержки опроса, можно несколько
+    # воркеров за прокси); без него — long polling для локальной разработки
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if webhook_url:
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("PORT", "8443")),
+            webhook_url=webhook_url,
+            secret_token=os.getenv("TG_SECRET")
+        )
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file